@@ -0,0 +1,80 @@
+import argparse
+import numpy as np
+import os
+from epsilon import EpsilonModel
+from track import Track
+from trajectory import Trajectory
+from vehicle import Vehicle
+
+###############################################################################
+## Argument parsing
+
+parser = argparse.ArgumentParser(
+  description='Calibrate the pre-computed compromise used by --estimated'
+)
+parser.add_argument('vehicle',
+  nargs=1, type=str,
+  help='path to JSON containing vehicle data'
+)
+parser.add_argument('tracks',
+  nargs='+', type=str,
+  help='paths to JSON containing track data'
+)
+parser.add_argument('--model',
+  type=str, dest='model',
+  default=os.path.join(
+    os.path.dirname(__file__), '..', 'data', 'models', 'epsilon.json'
+  ),
+  help='path to write the calibrated model JSON'
+)
+parser.add_argument('--ridge',
+  type=float, dest='ridge', default=1.0,
+  help='regularisation strength of the fitted model'
+)
+args = parser.parse_args()
+
+###############################################################################
+## Calibration
+
+# Corner detection parameters
+K_MIN = 0.03
+PROXIMITY = 40
+LENGTH = 10
+
+vehicle = Vehicle(args.vehicle[0])
+model = EpsilonModel(k_min=K_MIN, proximity=PROXIMITY, length=LENGTH,
+  ridge=args.ridge)
+
+names = []
+features = []
+epsilons = []
+for path in args.tracks:
+  track = Track(path)
+  trajectory = Trajectory(track, vehicle)
+  features.append(model.features(track, trajectory.s))
+  print("[ Minimising optimal compromise ]")
+  run_time = trajectory.minimise_optimal_compromise()
+  print("  epsilon = {:.4f}, run time = {:.3f}".format(
+    trajectory.epsilon, run_time
+  ))
+  names.append(track.name)
+  epsilons.append(trajectory.epsilon)
+
+print("[ Fitting model ]")
+model.fit(names, np.array(features), np.array(epsilons))
+
+print()
+print("=== Calibration ======================================================")
+print("{:<16}{:>12}{:>12}{:>12}".format("Track", "Searched", "Predicted", "Error"))
+for c in model.calibration:
+  print("{:<16}{:>12.4f}{:>12.4f}{:>12.4f}".format(
+    c["track"], c["searched"], c["predicted"], c["predicted"] - c["searched"]
+  ))
+print("Leave-one-out RMS error = {:.4f}".format(model.rms_error()))
+print("======================================================================")
+print()
+
+model_dir = os.path.dirname(os.path.abspath(args.model))
+if not os.path.exists(model_dir): os.makedirs(model_dir)
+model.write(args.model)
+print("[ Saved model to {} ]".format(args.model))
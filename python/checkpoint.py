@@ -0,0 +1,58 @@
+import json
+import os
+import time
+
+
+class Checkpoint:
+  """
+  Periodically persists optimiser state to a JSON file, so that a long run can
+  be resumed after a crash or pre-emption.
+  """
+
+
+  def __init__(self, path, interval=30, resume=False, inputs=None):
+    """
+    Create a checkpoint at the given path, written at most every :interval:
+    seconds. Existing state is only loaded if :resume: is set, and only if it
+    was produced from the same :inputs:.
+    """
+    self.path = path
+    self.interval = interval
+    self.inputs = inputs
+    self.state = {"inputs": inputs}
+    self.last = time.time()
+    if resume and os.path.exists(path): self.read()
+
+
+  def get(self, key, default=None):
+    """Return the saved state for a stage of the optimisation."""
+    return self.state.get(key, default)
+
+
+  def save(self, key, state, force=False):
+    """
+    Record the state of a stage of the optimisation, writing to disk if the
+    interval has elapsed or :force: is set.
+    """
+    self.state[key] = state
+    if force or time.time() - self.last >= self.interval: self.write()
+
+
+  def read(self):
+    """Read saved state from the checkpoint file."""
+    state = json.load(open(self.path))
+    if state.get("inputs") != self.inputs:
+      print("[ Inputs do not match {}, starting fresh ]".format(self.path))
+      return
+    self.state = state
+    print("[ Resuming from {} ]".format(self.path))
+
+
+  def write(self):
+    """Atomically write the current state to the checkpoint file."""
+    directory = os.path.dirname(os.path.abspath(self.path))
+    if not os.path.exists(directory): os.makedirs(directory)
+    tmp = self.path + ".tmp"
+    with open(tmp, 'w') as f: json.dump(self.state, f)
+    os.replace(tmp, self.path)
+    self.last = time.time()
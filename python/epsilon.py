@@ -0,0 +1,146 @@
+import json
+import numpy as np
+
+FEATURES = [
+  'avg_corner_curvature', 'max_corner_curvature', 'std_corner_curvature',
+  'corner_count', 'corner_fraction', 'length'
+]
+
+###############################################################################
+
+class EpsilonModel:
+  """
+  Predicts the optimal length-curvature compromise weight for a track from
+  cheap features of its centreline, using a ridge regression calibrated
+  against minimise_optimal_compromise.
+  """
+
+  def __init__(self, json_path=None, k_min=0.03, proximity=40, length=10,
+    ridge=1.0, eps_min=0, eps_max=0.2):
+    """Load a calibrated model, or create an empty one with the given corner
+    detection parameters and epsilon search bounds."""
+    self.k_min = k_min
+    self.proximity = proximity
+    self.length = length
+    self.ridge = ridge
+    self.eps_min = eps_min
+    self.eps_max = eps_max
+    self.mean = None
+    self.scale = None
+    self.weights = None
+    self.intercept = None
+    self.calibration = []
+    if json_path is not None: self.read(json_path)
+
+
+  def features(self, track, s):
+    """Compute the feature vector of a track, sampled along its centreline."""
+    corners, is_corner = track.corners(s, self.k_min, self.proximity, self.length)
+    k = track.mid.curvature(s[is_corner])
+    if k.size == 0: k = np.zeros(1)
+    return np.array([
+      np.mean(k),
+      np.max(k),
+      np.std(k),
+      corners.size // 2,
+      np.count_nonzero(is_corner) / is_corner.size,
+      track.length
+    ])
+
+
+  def fit(self, names, features, epsilons):
+    """
+    Fit the model to the searched optimal epsilons of a set of tracks, and
+    record leave-one-out prediction errors for each of them.
+    """
+    features = np.atleast_2d(features)
+    epsilons = np.asarray(epsilons, dtype=float)
+    self.calibration = []
+    for i, name in enumerate(names):
+      keep = np.arange(len(names)) != i
+      if np.count_nonzero(keep) > 0:
+        self.solve(features[keep], epsilons[keep])
+        predicted = self.predict_features(features[i])
+      else:
+        predicted = float('nan')
+      self.calibration.append({
+        "track": name,
+        "searched": float(epsilons[i]),
+        "predicted": float(predicted)
+      })
+    self.solve(features, epsilons)
+
+
+  def solve(self, features, epsilons):
+    """Solve the standardised ridge regression for the given samples."""
+    self.mean = np.mean(features, axis=0)
+    self.scale = np.std(features, axis=0)
+    self.scale[self.scale == 0] = 1
+    x = (features - self.mean) / self.scale
+    self.intercept = np.mean(epsilons)
+    a = x.T @ x + self.ridge * np.eye(x.shape[1])
+    self.weights = np.linalg.solve(a, x.T @ (epsilons - self.intercept))
+
+
+  def predict_features(self, features):
+    """
+    Predict epsilon from a precomputed feature vector, clipped to the bounds
+    of the epsilon search.
+    """
+    x = (features - self.mean) / self.scale
+    eps = float(self.intercept + x @ self.weights)
+    return min(max(eps, self.eps_min), self.eps_max)
+
+
+  def predict(self, track, s):
+    """Predict the optimal epsilon for a track."""
+    return self.predict_features(self.features(track, s))
+
+
+  def rms_error(self):
+    """Return the leave-one-out RMS error recorded during calibration."""
+    errors = [
+      c["predicted"] - c["searched"] for c in self.calibration
+      if not np.isnan(c["predicted"])
+    ]
+    if len(errors) == 0: return float('nan')
+    return float(np.sqrt(np.mean(np.square(errors))))
+
+
+  def read(self, path):
+    """Read a calibrated model from a JSON file."""
+    model_data = json.load(open(path))
+    if model_data["features"] != FEATURES:
+      raise ValueError("Model features {} do not match {}".format(
+        model_data["features"], FEATURES
+      ))
+    self.k_min = model_data["kMin"]
+    self.proximity = model_data["proximity"]
+    self.length = model_data["length"]
+    self.ridge = model_data["ridge"]
+    self.eps_min = model_data["epsMin"]
+    self.eps_max = model_data["epsMax"]
+    self.mean = np.array(model_data["mean"])
+    self.scale = np.array(model_data["scale"])
+    self.weights = np.array(model_data["weights"])
+    self.intercept = model_data["intercept"]
+    self.calibration = model_data["calibration"]
+
+
+  def write(self, path):
+    """Write the calibrated model to a JSON file."""
+    model_data = {
+      "features": FEATURES,
+      "kMin": self.k_min,
+      "proximity": self.proximity,
+      "length": self.length,
+      "ridge": self.ridge,
+      "epsMin": self.eps_min,
+      "epsMax": self.eps_max,
+      "mean": self.mean.tolist(),
+      "scale": self.scale.tolist(),
+      "weights": self.weights.tolist(),
+      "intercept": float(self.intercept),
+      "calibration": self.calibration
+    }
+    with open(path, 'w') as f: json.dump(model_data, f, indent=2)
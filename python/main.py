@@ -1,6 +1,9 @@
 import argparse
+import hashlib
 import os
+from checkpoint import Checkpoint
 from enum import IntEnum, unique
+from epsilon import EpsilonModel
 from plot import plot_corners, plot_path, plot_trajectory
 from track import Track
 from trajectory import Trajectory
@@ -47,6 +50,33 @@ methods.add_argument('--estimated',
   action='store_const', dest='method', const=Method.COMPROMISE_ESTIMATED,
   help='minimise a pre-computed length-curvature compromise'
 )
+parser.add_argument('--model',
+  type=str, dest='model',
+  default=os.path.join(
+    os.path.dirname(__file__), '..', 'data', 'models', 'epsilon.json'
+  ),
+  help='path to JSON containing the calibrated model used by --estimated'
+)
+parser.add_argument('--checkpoint',
+  type=str, dest='checkpoint',
+  help='path to JSON used to checkpoint optimiser state'
+)
+parser.add_argument('--checkpoint-interval',
+  type=float, dest='checkpoint_interval', default=30,
+  help='minimum number of seconds between checkpoints'
+)
+parser.add_argument('--resume',
+  action='store_true', dest='resume',
+  help='continue from the last checkpoint'
+)
+parser.add_argument('--time-budget',
+  type=float, dest='time_budget',
+  help='stop optimising after this many seconds, keeping the best path found'
+)
+parser.add_argument('--export-line',
+  type=str, dest='export_line',
+  help='path to write the racing line lookup table (.npy) for controllers'
+)
 parser.add_argument('--plot-corners',
   action='store_true', dest='plot_corners',
   help='plot detected corners'
@@ -72,34 +102,70 @@ args = parser.parse_args()
 ###############################################################################
 ## Generation
 
-track = Track(args.track[0])
-vehicle = Vehicle(args.vehicle[0])
-trajectory = Trajectory(track, vehicle)
+method_dirs = ['curvature', 'compromise', 'laptime', 'sectors', 'estimated']
 
 # Corner detection parameters
 K_MIN = 0.03
 PROXIMITY = 40
 LENGTH = 10
 
+def file_hash(path):
+  """Return the SHA-256 digest of a file's contents."""
+  with open(path, 'rb') as f: return hashlib.sha256(f.read()).hexdigest()
+
+track = Track(args.track[0])
+vehicle = Vehicle(args.vehicle[0])
+checkpoint_path = args.checkpoint or os.path.join(
+  os.path.dirname(__file__), '..', 'data', 'checkpoints', track.name,
+  method_dirs[args.method] + '.json'
+)
+checkpoint = Checkpoint(
+  checkpoint_path, args.checkpoint_interval, args.resume, {
+    "method": method_dirs[args.method],
+    "track": os.path.abspath(args.track[0]),
+    "trackHash": file_hash(args.track[0]),
+    "vehicle": os.path.abspath(args.vehicle[0]),
+    "vehicleHash": file_hash(args.vehicle[0])
+  }
+)
+trajectory = Trajectory(track, vehicle, checkpoint)
+
 if args.method is Method.CURVATURE:
   print("[ Minimising curvature ]")
-  run_time = trajectory.minimise_curvature()
+  run_time = trajectory.minimise_curvature(args.time_budget)
 elif args.method is Method.COMPROMISE:
   print("[ Minimising optimal compromise ]")
-  run_time = trajectory.minimise_optimal_compromise()
+  run_time = trajectory.minimise_optimal_compromise(
+    time_budget=args.time_budget
+  )
   print("  epsilon = {:.4f}".format(trajectory.epsilon))
 elif args.method is Method.DIRECT:
   print("[ Minimising lap time ]")
-  run_time = trajectory.minimise_lap_time()
+  run_time = trajectory.minimise_lap_time(args.time_budget)
 elif args.method is Method.COMPROMISE_SECTORS:
   print("[ Optimising sectors ]")
-  run_time = trajectory.optimise_sectors(K_MIN, PROXIMITY, LENGTH)
+  run_time = trajectory.optimise_sectors(
+    K_MIN, PROXIMITY, LENGTH, args.time_budget
+  )
 elif args.method is Method.COMPROMISE_ESTIMATED:
   print("[ Minimising pre-computed compromise ]")
-  mask = track.corners(trajectory.s, K_MIN, PROXIMITY, LENGTH)[1]
-  epsilon = 0.406 * track.avg_curvature(trajectory.s[mask])
-  print("  epsilon = {:.4f}".format(epsilon))
-  run_time = trajectory.minimise_compromise(epsilon)
+  if os.path.exists(args.model):
+    model = EpsilonModel(args.model)
+    epsilon = model.predict(track, trajectory.s)
+    print("  epsilon = {:.4f} (calibration RMS error = {:.4f})".format(
+      epsilon, model.rms_error()
+    ))
+    for c in model.calibration:
+      if c["track"] == track.name:
+        print("  searched epsilon = {:.4f}, leave-one-out error = {:.4f}".format(
+          c["searched"], c["predicted"] - c["searched"]
+        ))
+  else:
+    print("  No calibrated model at {}, using default".format(args.model))
+    mask = track.corners(trajectory.s, K_MIN, PROXIMITY, LENGTH)[1]
+    epsilon = 0.406 * track.avg_curvature(trajectory.s[mask])
+    print("  epsilon = {:.4f}".format(epsilon))
+  run_time = trajectory.minimise_compromise(epsilon, args.time_budget)
 else:
   raise ValueError("Did not recognise args.method {}".format(args.method))
 
@@ -111,13 +177,17 @@ print()
 print("=== Results ==========================================================")
 print("Lap time = {:.3f}".format(lap_time))
 print("Run time = {:.3f}".format(run_time))
+print("Converged = {}".format(trajectory.converged))
 print("======================================================================")
 print()
 
+if args.export_line is not None:
+  trajectory.racing_line().save(args.export_line)
+  print("[ Exported racing line to {} ]".format(args.export_line))
+
 ###############################################################################
 ## Plotting
 
-method_dirs = ['curvature', 'compromise', 'laptime', 'sectors', 'estimated']
 plot_dir = os.path.join(
   os.path.dirname(__file__), '..', 'data', 'plots', track.name,
   method_dirs[args.method]
@@ -0,0 +1,127 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class RacingLine:
+  """
+  Dense lookup table over a solved racing line, indexed by a KD-tree for fast
+  projection of vehicle positions. The table has rows s, x, y and v, sampled
+  by arc length. Closed lines repeat their first sample at s = length.
+  """
+
+
+  def __init__(self, npy_path=None, table=None, mmap=False):
+    """
+    Create a racing line from a table, or load one saved to a .npy file.
+    Construction copies the positions to float64 and builds the KD-tree, so
+    the whole table is read even if :mmap: is set.
+    """
+    if npy_path is not None:
+      table = np.load(npy_path, mmap_mode='r' if mmap else None)
+    self.table = table
+    self.s = table[0]
+    self.positions = table[1:3]
+    self.v = table[3]
+    self.length = self.s[-1]
+    self.closed = bool(np.all(self.positions[:,0] == self.positions[:,-1]))
+    self.xy = np.asarray(self.positions.T, dtype=float)
+    # Exclude the repeated sample of closed lines from the index
+    n = self.s.size - int(self.closed)
+    self.tree = cKDTree(self.xy[:n])
+
+
+  def save(self, path):
+    """Write the table to a .npy file."""
+    np.save(path, np.asarray(self.table))
+
+
+  def project(self, points):
+    """
+    Project x-y coordinates onto the racing line. Returns the progress along
+    the line, wrapped to [0, length) for closed lines, and the signed lateral
+    offset (positive to the left) of each point.
+    """
+    p = np.atleast_2d(np.asarray(points, dtype=float).T)
+    _, i = self.tree.query(p)
+    n = self.s.size
+
+    # Segment before the nearest sample, wrapping closed lines
+    a = i - 1
+    b = np.copy(i)
+    wrap = a < 0
+    if self.closed:
+      a[wrap] = n - 2
+      b[wrap] = n - 1
+    else:
+      a[wrap] = 0
+    s0, d0 = self.project_segments(p, a, b)
+
+    # Segment after the nearest sample
+    s1, d1 = self.project_segments(p, i, np.minimum(i + 1, n - 1))
+
+    after = np.abs(d1) < np.abs(d0)
+    return self.wrap(np.where(after, s1, s0)), np.where(after, d1, d0)
+
+
+  def project_segments(self, p, a, b):
+    """Project points onto the line segments between samples a and b."""
+    ab = self.xy[b] - self.xy[a]
+    ap = p - self.xy[a]
+    len2 = np.sum(ab**2, axis=1)
+    t = np.sum(ap * ab, axis=1) / np.where(len2 > 0, len2, 1)
+    t = np.clip(t, 0, 1)
+    q = ap - t[:,None] * ab
+    side = np.sign(ab[:,0] * ap[:,1] - ab[:,1] * ap[:,0])
+    s = self.s[a] + t * (self.s[b] - self.s[a])
+    return s, np.where(side < 0, -1, 1) * np.linalg.norm(q, axis=1)
+
+
+  def progress(self, points):
+    """Returns the progress along the racing line of x-y coordinates."""
+    return self.project(points)[0]
+
+
+  def position(self, s):
+    """Returns x-y coordinates at the given progress along the line."""
+    s = self.wrap(s)
+    return np.array([
+      np.interp(s, self.s, self.positions[0]),
+      np.interp(s, self.s, self.positions[1])
+    ])
+
+
+  def velocity(self, s):
+    """Returns the target velocity at the given progress along the line."""
+    return np.interp(self.wrap(s), self.s, self.v)
+
+
+  def velocity_at(self, points):
+    """Returns the target velocity at the projection of x-y coordinates."""
+    return self.velocity(self.progress(points))
+
+
+  def wrap(self, s):
+    """Wrap progress around closed lines."""
+    if self.closed: return np.mod(s, self.length)
+    return s
+
+
+###############################################################################
+
+
+def racing_line_table(path, s, v, closed, spacing):
+  """
+  Sample a path and its velocity profile every :spacing: metres. :v: gives
+  velocities at sample distances :s:, which exclude the overlapping element
+  for closed paths.
+  """
+  n = int(np.ceil(path.length / spacing)) + 1
+  s_dense = np.linspace(0, path.length, n)
+  if closed:
+    s = np.append(s, path.length)
+    v = np.append(v, v[0])
+  x, y = path.position(s_dense)
+  if closed:
+    x[-1] = x[0]
+    y[-1] = y[0]
+  return np.array([s_dense, x, y, np.interp(s_dense, s, v)], dtype=np.float32)
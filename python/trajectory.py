@@ -3,28 +3,44 @@ import numpy as np
 import os
 import time
 from functools import partial
-from multiprocessing import Pool
+from multiprocessing import Pool, TimeoutError
 from path import Path
 from plot import plot_path
+from racing_line import RacingLine, racing_line_table
 from scipy.optimize import Bounds, minimize, minimize_scalar
 from track import Track
 from utils import define_corners, idx_modulo
 from velocity import VelocityProfile
 
+class DeadlineExceeded(Exception):
+  """Raised within an objective function to stop an optimiser at its time
+  budget."""
+
+###############################################################################
+
 class Trajectory:
   """
   Stores the geometry and dynamics of a path, handling optimisation of the
   racing line. Samples are taken every metre.
+
+  Each optimisation method accepts a time_budget in seconds, after which the
+  best path found so far is kept. Whether the method finished within its
+  budget is recorded in self.converged.
   """
   
 
-  def __init__(self, track, vehicle):
-    """Store track and vehicle and initialise a centerline path."""
+  def __init__(self, track, vehicle, checkpoint=None):
+    """
+    Store track and vehicle and initialise a centerline path. Optimiser state
+    is periodically saved to :checkpoint:, if given.
+    """
     self.track = track
     self.ns = math.ceil(track.length)
     self.update(np.full(track.size, 0.5))
     self.vehicle = vehicle
     self.velocity = None
+    self.checkpoint = checkpoint
+    self.converged = None
 
 
   def update(self, alphas):
@@ -48,7 +64,18 @@ class Trajectory:
     return np.sum(np.diff(self.s) / self.velocity.v)
 
 
-  def minimise_curvature(self):
+  def racing_line(self, spacing=0.1):
+    """
+    Build a queryable racing line from the current path and its velocity
+    profile, sampled every :spacing: metres.
+    """
+    self.update_velocity()
+    return RacingLine(table=racing_line_table(
+      self.path, self.s[:-1], self.velocity.v, self.track.closed, spacing
+    ))
+
+
+  def minimise_curvature(self, time_budget=None):
     """Generate a path minimising curvature."""
 
     def objfun(alphas):
@@ -56,17 +83,12 @@ class Trajectory:
       return self.path.gamma2(self.s)
 
     t0 = time.time()
-    res = minimize(
-      fun=objfun,
-      x0=np.full(self.track.size, 0.5),
-      method='L-BFGS-B',
-      bounds=Bounds(0.0, 1.0)
-    )
-    self.update(res.x)
+    deadline = None if time_budget is None else t0 + time_budget
+    self.converged = self.minimise_alphas(objfun, 'curvature', deadline)
     return time.time() - t0
 
 
-  def minimise_compromise(self, eps):
+  def minimise_compromise(self, eps, time_budget=None):
     """
     Generate a path minimising a compromise between path curvature and path
     length. eps gives the weight for path length.
@@ -79,46 +101,106 @@ class Trajectory:
       return (1-eps)*k + eps*d
 
     t0 = time.time()
-    res = minimize(
-      fun=objfun,
-      x0=np.full(self.track.size, 0.5),
-      method='L-BFGS-B',
-      bounds=Bounds(0.0, 1.0)
+    deadline = None if time_budget is None else t0 + time_budget
+    self.converged = self.minimise_alphas(
+      objfun, 'compromise', deadline, epsilon=eps
     )
-    self.update(res.x)
     return time.time() - t0
 
 
-  def minimise_optimal_compromise(self, eps_min=0, eps_max=0.2):
+  def minimise_optimal_compromise(self, eps_min=0, eps_max=0.2,
+    time_budget=None):
     """
     Determine the optimal compromise weight when using optimise_compromise to
     produce a path.
     """
 
     def objfun(eps):
-      self.minimise_compromise(eps)
+      # Replay evaluations completed before a resumed checkpoint
+      if eps in replay: return replay[eps]
+      if deadline is not None and time.time() > deadline:
+        raise DeadlineExceeded()
+      budget = None if deadline is None else deadline - time.time()
+      self.minimise_compromise(eps, budget)
       self.update_velocity()
       t = self.lap_time()
+      if t < best["t"]:
+        best.update(t=t, epsilon=eps, alphas=np.copy(self.alphas))
+      # A cut-off evaluation is only a candidate path, not a lap time for the
+      # search, so it is kept out of the history and checkpoint
+      if not self.converged: raise DeadlineExceeded()
       if self.epsilon_history.size > 0:
         self.epsilon_history = np.vstack((self.epsilon_history, [eps, t]))
       else:
         self.epsilon_history = np.array([eps, t])
+      if self.checkpoint is not None:
+        history = self.epsilon_history.reshape(-1, 2)
+        self.checkpoint.save('optimal_compromise', {
+          "epsMin": eps_min,
+          "epsMax": eps_max,
+          "epsilon_history": history.tolist(),
+          "objective": float(np.min(history[:,1])),
+          "done": False
+        }, force=True)
       return t
 
-    self.epsilon_history = np.array([])
     t0 = time.time()
-    res = minimize_scalar(
-      fun=objfun,
-      method='bounded',
-      bounds=(eps_min, eps_max)
-    )
-    self.epsilon = res.x
-    self.minimise_compromise(self.epsilon)
+    saved = self.checkpoint.get('optimal_compromise') if self.checkpoint else None
+    if saved and (saved["epsMin"], saved["epsMax"]) != (eps_min, eps_max):
+      saved = None
+    history = saved["epsilon_history"] if saved else []
+    self.epsilon_history = np.array(history)
+    if saved and saved["done"]:
+      self.epsilon = saved["epsilon"]
+      self.update(np.array(saved["alphas"]))
+      self.converged = True
+      return time.time() - t0
+    replay = {eps: t for eps, t in history}
+    best = {"t": math.inf, "epsilon": None, "alphas": None}
+    deadline = None if time_budget is None else t0 + time_budget
+    try:
+      res = minimize_scalar(
+        fun=objfun,
+        method='bounded',
+        bounds=(eps_min, eps_max)
+      )
+      self.epsilon = res.x
+      self.converged = True
+    except DeadlineExceeded:
+      self.converged = False
+
+    # Reuse the path already found for the chosen epsilon where possible,
+    # otherwise it was replayed from a checkpoint and must be regenerated
+    if self.converged and best["epsilon"] == self.epsilon:
+      self.update(best["alphas"])
+    elif self.converged:
+      budget = None if deadline is None else max(deadline - time.time(), 0)
+      self.minimise_compromise(self.epsilon, budget)
+
+    # Out of time, keep the best path found so far
+    if not self.converged:
+      if best["alphas"] is not None:
+        self.epsilon = best["epsilon"]
+        self.update(best["alphas"])
+      else:
+        self.epsilon = math.nan
+        self.update(np.full(self.track.size, 0.5))
+    if self.checkpoint is not None and self.converged:
+      history = self.epsilon_history.reshape(-1, 2)
+      self.checkpoint.save('optimal_compromise', {
+        "epsMin": eps_min,
+        "epsMax": eps_max,
+        "epsilon_history": history.tolist(),
+        "objective": float(np.min(history[:,1])),
+        "epsilon": float(self.epsilon),
+        "alphas": self.alphas.tolist(),
+        "done": True
+      }, force=True)
     end = time.time()
     return end - t0
 
 
-  def minimise_lap_time(self):
+  def minimise_lap_time(self, time_budget=None):
     """
     Generate a path that directly minimises lap time.
     """
@@ -129,78 +211,178 @@ class Trajectory:
       return self.lap_time()
 
     t0 = time.time()
-    res = minimize(
-      fun=objfun,
-      x0=np.full(self.track.size, 0.5),
-      method='L-BFGS-B',
-      bounds=Bounds(0.0, 1.0)
-    )
-    self.update(res.x)
+    deadline = None if time_budget is None else t0 + time_budget
+    self.converged = self.minimise_alphas(objfun, 'laptime', deadline)
     return time.time() - t0
 
 
-  def optimise_sectors(self, k_min, proximity, length):
+  def optimise_sectors(self, k_min, proximity, length, time_budget=None):
     """
     Generate a path that optimises the path through each sector, and merges
-    the results along intervening straights.
+    the results along intervening straights. Sectors not finished within the
+    time budget follow the centreline.
     """
 
     # Define sectors
     t0 = time.time()
+    deadline = None if time_budget is None else t0 + time_budget
     corners, _ = self.track.corners(self.s, k_min, proximity, length)
 
-    # Optimise path for each sector in parallel
+    # Skip sectors completed before a resumed checkpoint
     nc = corners.shape[0]
+    params = {"kMin": k_min, "proximity": proximity, "length": length}
+    saved = self.checkpoint.get('sectors') if self.checkpoint else None
+    if saved and saved["params"] != params: saved = None
+    sectors = {
+      int(i): np.array(a) for i, a in saved["alphas"].items()
+    } if saved else {}
+    remaining = [i for i in range(nc) if i not in sectors]
+
+    # Optimise path for each remaining sector in parallel
     pool = Pool(os.cpu_count() - 1)
-    alphas = pool.map(
-      partial(optimise_sector_compromise, corners=corners, traj=self),
-      range(nc)
+    results = pool.imap_unordered(
+      partial(
+        optimise_sector_compromise, corners=corners, traj=self,
+        deadline=deadline
+      ),
+      remaining
     )
-    pool.close()
+    self.converged = True
+    for _ in remaining:
+      try:
+        timeout = None if deadline is None else max(deadline - time.time(), 0)
+        i, sector_alphas, converged = results.next(timeout)
+      except TimeoutError:
+        self.converged = False
+        break
+      if not converged:
+        self.converged = False
+        continue
+      sectors[i] = sector_alphas
+      if self.checkpoint is not None:
+        self.checkpoint.save('sectors', {
+          "params": params,
+          "alphas": {str(j): a.tolist() for j, a in sectors.items()}
+        }, force=True)
+    if self.converged: pool.close()
+    else: pool.terminate()
+
+    # Fall back to the centreline for unfinished sectors
+    n = self.track.size
+    for i in range(nc):
+      if i in sectors: continue
+      idxs, weights = sector_weights(i, corners, n)
+      sectors[i] = np.zeros(n)
+      sectors[i][idxs] = 0.5 * weights
 
     # Merge sectors and update trajectory
-    alphas = np.sum(alphas, axis=0)
+    alphas = np.sum([sectors[i] for i in range(nc)], axis=0)
     self.update(alphas)
     return time.time() - t0
 
+
+  def minimise_alphas(self, objfun, key, deadline=None, **params):
+    """
+    Minimise objfun over the control point alphas and update the path with
+    the result. The best alphas found are checkpointed under :key:, and are
+    used to warm start the search when resuming with matching :params:.
+    The search stops at :deadline:, keeping the best alphas found so far.
+    Returns whether the search finished before the deadline.
+    """
+    saved = self.checkpoint.get(key) if self.checkpoint else None
+    if saved and any(saved.get(k) != v for k, v in params.items()): saved = None
+    if saved and saved["done"]:
+      self.update(np.array(saved["alphas"]))
+      return True
+    x0 = np.array(saved["alphas"]) if saved else np.full(self.track.size, 0.5)
+    best = {"objective": math.inf, "alphas": x0}
+
+    def tracked(alphas):
+      if deadline is not None and time.time() > deadline:
+        raise DeadlineExceeded()
+      f = objfun(alphas)
+      if f < best["objective"]:
+        best.update(objective=f, alphas=np.copy(alphas))
+        if self.checkpoint is not None:
+          self.checkpoint.save(key, dict(params,
+            alphas=alphas.tolist(), objective=float(f), done=False
+          ))
+      return f
+
+    try:
+      res = minimize(
+        fun=tracked,
+        x0=x0,
+        method='L-BFGS-B',
+        bounds=Bounds(0.0, 1.0)
+      )
+      alphas, objective, converged = res.x, res.fun, True
+    except DeadlineExceeded:
+      alphas, objective, converged = best["alphas"], best["objective"], False
+    self.update(alphas)
+    if self.checkpoint is not None:
+      self.checkpoint.save(key, dict(params,
+        alphas=alphas.tolist(), objective=float(objective), done=converged
+      ), force=True)
+    return converged
+
 ###############################################################################
 
-def optimise_sector_compromise(i, corners, traj):
+def optimise_sector_compromise(i, corners, traj, deadline=None):
   """
   Builds a new Track for the given corner sequence, and optimises the path
-  through it by the compromise method.
+  through it by the compromise method. If the sector is not finished by the
+  deadline, the centreline is used instead.
   """
   
   # Represent sector as new Track
-  nc = corners.shape[0]
   n = traj.track.size
-  a = corners[(i-1)%nc,1]  # Sector start
-  b = corners[i,0]         # Corner entry
-  c = corners[i,1]         # Corner exit
-  d = corners[(i+1)%nc,0]  # Sector end
-  idxs = idx_modulo(a,d,n)
+  idxs, weights = sector_weights(i, corners, n)
   sector = Trajectory(
     Track(left=traj.track.left[:,idxs], right=traj.track.right[:,idxs]),
     traj.vehicle
   )
   
   # Optimise path through sector
-  sector.minimise_optimal_compromise()
+  budget = None if deadline is None else deadline - time.time()
+  rt = sector.minimise_optimal_compromise(time_budget=budget)
+  if not sector.converged:
+    sector.epsilon = math.nan
+    sector.update(np.full(sector.track.size, 0.5))
   
   # Weight alphas for merging across straights
-  weights = np.ones((d-a)%n)
-  weights[:(b-a)%n] = np.linspace(0, 1, (b-a)%n)
-  weights[(c-a)%n:] = np.linspace(1, 0, (d-c)%n)
   alphas = np.zeros(n)
   alphas[idxs] = sector.alphas * weights
   
   # Report and plot sector results
-  print("  Sector {:d}: eps={:.4f}, run time={:.2f}s".format(
-    i, sector.epsilon, rt
-  ))
+  if sector.converged:
+    print("  Sector {:d}: eps={:.4f}, run time={:.2f}s".format(
+      i, sector.epsilon, rt
+    ))
+  else:
+    print("  Sector {:d}: timed out, using centreline, run time={:.2f}s".format(
+      i, rt
+    ))
   # plot_path(
   #   "./plots/" + traj.track.name + "_sector" + str(i) + ".png",
   #   sector.track.left, sector.track.right, sector.path.position(sector.s)
   # )
   
-  return alphas
+  return i, alphas, sector.converged
+
+
+def sector_weights(i, corners, n):
+  """
+  Returns the control point indices spanned by a sector, and the weights used
+  to merge its alphas across the straights either side.
+  """
+  nc = corners.shape[0]
+  a = corners[(i-1)%nc,1]  # Sector start
+  b = corners[i,0]         # Corner entry
+  c = corners[i,1]         # Corner exit
+  d = corners[(i+1)%nc,0]  # Sector end
+  idxs = idx_modulo(a,d,n)
+  weights = np.ones((d-a)%n)
+  weights[:(b-a)%n] = np.linspace(0, 1, (b-a)%n)
+  weights[(c-a)%n:] = np.linspace(1, 0, (d-c)%n)
+  return idxs, weights